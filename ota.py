@@ -13,18 +13,27 @@ Update Intervals
    you call "updated()" after the timer has expired, you will get updates and the Pico
    WILL BE RESET (i.e. rebooted). You can avoid having your Pico reset by simply not
    specifying an update interval. But, you will be responsible for tracking timers and
-   how often you want to do updates.
+   how often you want to do updates. The time of the last check is saved, so rebooting
+   part way through an interval does not cause an early check.
+
+   Intervals are timed with the monotonic "utime.ticks_ms()" clock, which is not thrown
+   off by the wall clock being set. Tick differences only cover about 6.2 days (a tick
+   period of 2^30 ms on the Pico W), so intervals of 6 days or more are timed with the
+   wall clock ("utime.time()") instead. Set the wall clock (e.g. with NTP) if you use
+   an interval that long.
 
 Features:
   - Track files in multiple repositories.
   - Uses the GitHub REST API to track file updates.
 
-There are 5 classes defined here:
+There are 7 classes defined here:
   1. OTAUpdater: Manages the updating of files to the latest version.
-  2. OTAFileMetadata: Stores metadata for individual files.
-  3. OTADatabase: Handles read/write of file info to a local "database."
-  4. OTANewFileWillNotValidate: Exception for new files that will not validate prior to use.
-  5. OTANoMemory: Exception for running out of memory due to a known 'urequests' bug.
+  2. OTAHTTPSession: A keep-alive HTTPS client shared by all GitHub requests.
+  3. OTARepo: Polls a single GitHub repository for new commits.
+  4. OTAFileMetadata: Stores metadata for individual files.
+  5. OTADatabase: Handles read/write of file info to a local "database."
+  6. OTANewFileWillNotValidate: Exception for new files that will not validate prior to use.
+  7. OTANoMemory: Exception for running out of memory (e.g. a fragmented heap).
 
 Tested on:
   - Raspberry Pi Pico W - firmware v1.20.0 (2023-04-26 vintage)
@@ -71,10 +80,28 @@ import time
 import machine
 import ubinascii
 import uos
-import urequests as requests
+import usocket
+import ussl
 import utime
 
 
+def file_exists(filename):
+    """
+    Find out if a file exists. A single stat call is much cheaper than building
+    a list of every file in the directory with os.listdir().
+
+    :param filename: A file name
+    :type filename: str
+    :return: True or False
+    :rtype: bool
+    """
+    try:
+        uos.stat(filename)
+    except OSError:
+        return False
+    return True
+
+
 def calculate_github_sha(filename):
     """
     This will generate the same sha1 value as GitHub's own calculation
@@ -86,28 +113,25 @@ def calculate_github_sha(filename):
     """
     try:
         # Does the file exist?
-        uos.stat(filename)
+        size = uos.stat(filename)[6]
     except OSError:
         # Nope, guess not
         return ''
     else:
         s = hashlib.sha1()
+        # The header needs the size up front, so the contents can be hashed as they are read
+        s.update("blob %u\0" % size)
         # Open the file in binary mode
         with open(filename, "rb") as file:
             chunk_size = 1024
-            data = bytes()
             while True:
                 chunk = file.read(chunk_size)
                 if not chunk:
                     break
-                data += chunk
-
-        s.update("blob %u\0" % len(data))
-        s.update(data)
-        s_binary = s.digest()
+                s.update(chunk)
 
         # Convert the binary digest to a hexadecimal string
-        return ''.join('{:02x}'.format(byte) for byte in s_binary)
+        return ubinascii.hexlify(s.digest()).decode()
 
 
 def valid_code(file_path) -> bool:
@@ -121,17 +145,24 @@ def valid_code(file_path) -> bool:
     :rtype: bool
     """
     try:
+        # Close the file before compiling, so its buffer can go too
         with open(file_path, 'r') as file:
             python_code = file.read()
-            compile(python_code, file_path, 'exec')
-            return True  # Code is valid
-    except (SyntaxError, FileNotFoundError):
+        code = compile(python_code, file_path, 'exec')
+        # Neither the source nor the compiled code is needed any more
+        del python_code, code
+        return True  # Code is valid
+    except (SyntaxError, OSError):
         return False  # Code is invalid or file not found
+    finally:
+        gc.collect()
 
 
 class OTANoMemory(Exception):
     """
-    Due to a known mem leak issue in 'urequests', flag when we run into it.
+    Flag when there is not enough free memory to continue. The TLS connection in
+    OTAHTTPSession needs large buffers, and a fragmented heap can leave too little
+    free space for another request or file download.
     """
 
     def __init__(self, message="Insufficient memory to continue"):
@@ -162,6 +193,12 @@ class OTAUpdater:
         repo_dct - A dictionary of repositories and their files to be updated
     """
 
+    # Intervals of this many seconds or more are timed with the wall clock. Tick
+    # differences only cover half the tick period of 2^30 ms (about 6.2 days).
+    TICKS_MAX_INTERVAL_SECONDS = 6 * 24 * 60 * 60
+    OTA_MINIMUM_MEMORY = 32000
+    OTA_COLLECT_MARGIN = 8000  # Collect garbage when free memory is within this of the minimum
+
     def __init__(self, github_userid, github_token, repo_dct, update_interval_minutes=None,
                  update_on_initialization=False, debug=False, save_backups=False):
         """
@@ -177,14 +214,29 @@ class OTAUpdater:
         """
         gc.enable()  # In case it is not in your 'boot.py' file
         self.files_obj = []
+        self.repos_obj = []
         self.debug = debug
         self.save_backups = save_backups
+        self.session = OTAHTTPSession(debug=self.debug)
+        # Every request carries the same credentials, so the header dicts are built once
+        # here and shared by reference, rather than each file having its own copy.
+        self.request_header = {
+            "Authorization": "token " + github_token,
+            'User-Agent': github_userid
+        }
+        self.raw_header = self.request_header.copy()
+        self.raw_header['Accept'] = 'application/vnd.github.raw'
+        self.sha_header = self.request_header.copy()
+        self.sha_header['Accept'] = 'application/vnd.github.sha'
 
         for repo in repo_dct.keys():
+            repo_files = []
             for file in repo_dct[repo]:
-                self.files_obj.append(OTAFileMetadata(github_userid, github_token, repo, file,
-                                                      debug=self.debug, save_backups=self.save_backups))
-
+                repo_files.append(OTAFileMetadata(repo, file, self.session, self.raw_header,
+                                                  debug=self.debug, save_backups=self.save_backups))
+            self.files_obj.extend(repo_files)
+            self.repos_obj.append(OTARepo(repo, repo_files, self.session, self.request_header, self.sha_header,
+                                          debug=self.debug))
         self.db = OTADatabase(self.files_obj, debug=self.debug)
         self.update_interval_minutes = update_interval_minutes  # Update interval in minutes
         if self.update_interval_minutes is not None:
@@ -192,34 +244,70 @@ class OTAUpdater:
         else:
             self.update_interval_seconds = None  # No timer
 
-        self.last_update_time = None  # Initialize last update time
+        # The interval is timed with the monotonic ticks_ms() clock, which restarts at 0
+        # on every boot, unless it is too long for ticks (see the module docs). The wall
+        # clock time of the last update is kept in the database so that a reboot part
+        # way through an interval does not start a new one.
+        self.use_ticks = (self.update_interval_seconds is not None and
+                          self.update_interval_seconds < self.TICKS_MAX_INTERVAL_SECONDS)
+        self.last_update_ticks = None
+        self.last_update_time = None
+        last_update_time = self.db.get_last_update_time()
+        if self.update_interval_seconds is not None and last_update_time is not None:
+            elapsed_time = utime.time() - last_update_time
+            # The wall clock may not be set yet (e.g. no NTP sync). Only trust a sensible value.
+            if 0 <= elapsed_time < self.update_interval_seconds:
+                if self.use_ticks:
+                    self.last_update_ticks = utime.ticks_add(utime.ticks_ms(), -elapsed_time * 1000)
+                else:
+                    self.last_update_time = last_update_time
 
         if update_on_initialization:
             self.updated(force_update=True)
+        elif self.last_update_ticks is None and self.last_update_time is None:
+            # Pull the latest versions from GitHub
+            self.fetch_updates()
+            for entry in self.files_obj:
+                self.db.stage(entry.to_json())
+            self.db.commit()
 
-    def debug_print(self, msg):
+    def mem_check(self):
         """
-        Print only when debug enabled
+        Make sure there is enough free memory for a round of requests over the TLS
+        session, since its buffers and heap fragmentation can use up a lot of it. A
+        collection walks the whole heap, so only do one when memory is getting low.
         """
+        free_mem = gc.mem_free()
+        if free_mem < self.OTA_MINIMUM_MEMORY + self.OTA_COLLECT_MARGIN:
+            gc.collect()
+            free_mem = gc.mem_free()
         if self.debug:
-            print(msg)
+            print(f"OTAU: Free mem: {free_mem}")
+        if free_mem < self.OTA_MINIMUM_MEMORY:
+            raise OTANoMemory()
 
     def fetch_updates(self):
         """
-        Walk through all the OTAFileMetadata objects in a list and update each to
-        the latest GitHub version
+        Walk through all the OTARepo objects in a list and update the files of any
+        repo with new commits to the latest GitHub version
 
         :return: Nothing
         """
+        # Once per cycle, before the TLS connection is opened
+        self.mem_check()
         try:
-            self.debug_print("OTAU: Pulling latest GitHub versions ...")
-            for ndx, _ in enumerate(self.files_obj):
-                file = self.files_obj[ndx].get_filename()
-                self.debug_print(f"OTAU: ... {file}")
-                self.files_obj[ndx].update_latest()
-            self.debug_print("OTAU: GitHub pulls completed")
+            if self.debug:
+                print("OTAU: Pulling latest GitHub versions ...")
+            for repo in self.repos_obj:
+                if self.debug:
+                    print(f"OTAU: ... {repo.repo}")
+                repo.fetch_updates()
+            if self.debug:
+                print("OTAU: GitHub pulls completed")
         except OTANewFileWillNotValidate:
             print("OTAU: Validation error. Cannot update")
+        finally:
+            self.session.close()
 
     def _check_for_updates(self):
         """
@@ -227,20 +315,25 @@ class OTAUpdater:
 
         :return: True if updates were applied, False otherwise.
         """
-        self.debug_print("OTAU: Checking for updates")
+        if self.debug:
+            print("OTAU: Checking for updates")
         files_updated_flag = False
         self.fetch_updates()
-        self.debug_print("OTAU: Comparing GitHub version with local versions ...")
+        if self.debug:
+            print("OTAU: Comparing GitHub version with local versions ...")
         for entry in self.files_obj:
-            self.debug_print(f"OTAU: ... {entry.get_filename()}")
+            if self.debug:
+                print(f"OTAU: ... {entry.filename}")
             if entry.new_version_available():
-                self.debug_print(f'OTAU: --> {entry.get_filename()} updated')
-                self.debug_print(f'OTAU: current: {entry.get_current()}')
-                self.debug_print(f'OTAU: latest:  {entry.get_latest()}')
-                entry.set_current_to_latest()
-                self.db.update(entry.to_json())
-                if not files_updated_flag:
+                if self.debug:
+                    print(f'OTAU: --> {entry.filename} updated')
+                    print(f'OTAU: current: {entry.current}')
+                    print(f'OTAU: latest:  {entry.latest}')
+                if entry.set_current_to_latest():
+                    self.db.stage(entry.to_json())
                     files_updated_flag = True
+        # Write all the changes to flash at once
+        self.db.commit()
 
         return files_updated_flag
 
@@ -252,48 +345,408 @@ class OTAUpdater:
         :type force_update: bool
         :return: True if updates were applied, False otherwise.
         """
-        current_time = utime.time()
-
         # If force_update is True, always check for updates
         if force_update:
-            self.debug_print("OTAU: Forcing update")
-            return self._check_and_apply_updates(current_time)
+            if self.debug:
+                print("OTAU: Forcing update")
+            return self._check_and_apply_updates()
 
         # Check if the update interval has expired (if a timer is set)
         if self.update_interval_seconds is not None:
-            self.debug_print(f"OTAU: current_time: {current_time} and last_update_time: {self.last_update_time}")
-
-            elapsed_time = current_time - self.last_update_time
-            if self.last_update_time is None or elapsed_time >= self.update_interval_seconds:
-                self.debug_print("OTAU: Update interval expired OR last_update_time is NULL")
-                self.debug_print(f"OTAU: last_update_time is {self.last_update_time}")
-                self.debug_print(f"OTAU: elapsed time {elapsed_time} >= {self.update_interval_seconds}")
-                return self._check_and_apply_updates(current_time)
+            if self.last_update_ticks is None and self.last_update_time is None:
+                if self.debug:
+                    print("OTAU: No last update time")
+                return self._check_and_apply_updates()
+
+            if self.use_ticks:
+                elapsed_time = utime.ticks_diff(utime.ticks_ms(), self.last_update_ticks) // 1000
+            else:
+                elapsed_time = utime.time() - self.last_update_time
+            # A negative elapsed time means the ticks wrapped (updated() was not called for
+            # more than half a tick period) or the wall clock was set back. Either way, check.
+            if elapsed_time < 0 or elapsed_time >= self.update_interval_seconds:
+                if self.debug:
+                    print("OTAU: Update interval expired")
+                    print(f"OTAU: elapsed time {elapsed_time} >= {self.update_interval_seconds}")
+                return self._check_and_apply_updates()
             else:
-                self.debug_print("OTAU: Update interval not yet expired")
+                if self.debug:
+                    print("OTAU: Update interval not yet expired")
                 return False
         else:
-            self.debug_print("OTAU: No timer, always check for updates")
-            return self._check_and_apply_updates(current_time)
+            if self.debug:
+                print("OTAU: No timer, always check for updates")
+            return self._check_and_apply_updates()
 
-    def _check_and_apply_updates(self, current_time) -> bool:
+    def _check_and_apply_updates(self) -> bool:
         """
         Check for updates and apply them if updates are available.
 
-        :param current_time: The current time.
-        :type current_time: int
         :return: True if updates were applied, False otherwise.
         """
+        current_time = utime.time()
+        if self.update_interval_seconds is not None:
+            # Only needed to time the interval across reboots. Staged now, written
+            # along with any file updates.
+            self.db.set_last_update_time(current_time)
         if self._check_for_updates():
-            self.debug_print("OTAU: Updates applied. Resetting system.")
+            if self.debug:
+                print("OTAU: Updates applied. Resetting system.")
             utime.sleep(1)  # Sleep for a moment before resetting
             machine.reset()
         else:
-            self.last_update_time = current_time  # Update the last update time
-            self.debug_print("OTAU: No updates found")
+            # Update the last update time
+            self.last_update_ticks = utime.ticks_ms()
+            self.last_update_time = current_time
+            if self.debug:
+                print("OTAU: No updates found")
             return False
 
 
+class OTAHTTPSession:
+    """
+    A minimal HTTP/1.1 client. A single TLS connection to the GitHub API is opened on
+    first use and kept alive for all the requests that follow, rather than paying for
+    a TLS handshake (and its buffers) on every request.
+
+    Attributes:
+        host - The host to connect to
+    """
+
+    GITHUB_API_HOST = 'api.github.com'
+    HTTPS_PORT = 443
+    READ_CHUNK_SIZE = 1024
+
+    def __init__(self, host=GITHUB_API_HOST, debug=False):
+        """
+        Initializer
+
+        :param host: The host to connect to
+        :type host: str
+        :param debug: Enable debug
+        :type debug: bool
+        """
+        self.host = host
+        self.debug = debug
+        self.sock = None
+
+    def connect(self):
+        """
+        Open the TLS connection
+
+        :return: Nothing
+        """
+        if self.debug:
+            print(f"OTAH: Connecting to {self.host}")
+        addr = usocket.getaddrinfo(self.host, self.HTTPS_PORT, 0, usocket.SOCK_STREAM)[0][-1]
+        sock = usocket.socket(usocket.AF_INET, usocket.SOCK_STREAM)
+        try:
+            sock.connect(addr)
+            self.sock = ussl.wrap_socket(sock, server_hostname=self.host)
+        except OSError:
+            sock.close()
+            raise
+
+    def close(self):
+        """
+        Close the TLS connection, if there is one
+
+        :return: Nothing
+        """
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def get(self, path, headers, etag=None, sink=None):
+        """
+        Make a GET request, reusing the open connection if there is one
+
+        :param path: The path to request (e.g. '/repos/...')
+        :type path: str
+        :param headers: Request headers
+        :type headers: dict
+        :param etag: If set, make the request conditional on the resource having changed
+        :type etag: str
+        :param sink: If set, a '200 OK' body is passed to this function a piece at a time
+                     as it arrives, rather than being returned
+        :type sink: function
+        :return: The status code, the response headers (lower case names) and the body
+        :rtype: tuple
+        """
+        if self.sock is None:
+            self.connect()
+            status = self.send(path, headers, etag)
+        else:
+            try:
+                status = self.send(path, headers, etag)
+            except OSError:
+                # The server may have dropped the idle connection. Try once more on a new one.
+                if self.debug:
+                    print("OTAH: Connection lost. Reconnecting")
+                self.connect()
+                status = self.send(path, headers, etag)
+        try:
+            response_headers = {}
+            while True:
+                line = self.sock.readline()
+                if not line or line == b'\r\n':
+                    break
+                key, value = line.decode().split(':', 1)
+                response_headers[key.strip().lower()] = value.strip()
+            body = self.read_body(status, response_headers, sink if status == 200 else None)
+        except Exception:
+            # The connection is in an unknown state. Don't reuse it.
+            self.close()
+            raise
+        if response_headers.get('connection', '').lower() == 'close':
+            self.close()
+        return status, response_headers, body
+
+    def send(self, path, headers, etag=None):
+        """
+        Send a GET request on the open connection and read the status line of the response
+
+        :return: The status code
+        :rtype: int
+        """
+        request = f'GET {path} HTTP/1.1\r\nHost: {self.host}\r\nConnection: keep-alive\r\n'
+        for key in headers:
+            request += f'{key}: {headers[key]}\r\n'
+        if etag:
+            request += f'If-None-Match: {etag}\r\n'
+        try:
+            self.sock.write(request + '\r\n')
+            status_line = self.sock.readline()
+            if not status_line:
+                raise OSError('Connection closed by server')
+            return int(status_line.split(None, 2)[1])
+        except Exception:
+            self.close()
+            raise
+
+    def read_body(self, status, response_headers, sink=None):
+        """
+        Read the response body according to the response headers
+
+        :return: The response body (empty if it went to the sink)
+        :rtype: bytes
+        """
+        if status == 304 or status == 204:
+            return b''
+        if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.sock.readline().split(b';', 1)[0], 16)
+                if size == 0:
+                    # Skip any trailers
+                    while self.sock.readline() not in (b'\r\n', b''):
+                        pass
+                    break
+                if sink:
+                    self.read_to_sink(size, sink)
+                else:
+                    chunks.append(self.read_exactly(size))
+                self.sock.readline()  # The CRLF after each chunk
+            return b''.join(chunks)
+        if 'content-length' in response_headers:
+            size = int(response_headers['content-length'])
+            if sink:
+                self.read_to_sink(size, sink)
+                return b''
+            return self.read_exactly(size)
+        # No length given. The body runs until the server closes the connection.
+        if sink:
+            while True:
+                data = self.sock.read(self.READ_CHUNK_SIZE)
+                if not data:
+                    break
+                sink(data)
+            body = b''
+        else:
+            body = self.sock.read()
+        self.close()
+        return body
+
+    def read_to_sink(self, size, sink):
+        """
+        Pass an exact number of bytes from the connection to a sink, a chunk at a time
+
+        :param size: The number of bytes to read
+        :type size: int
+        :param sink: The function each chunk is passed to
+        :type sink: function
+        :return: Nothing
+        """
+        while size > 0:
+            data = self.sock.read(min(size, self.READ_CHUNK_SIZE))
+            if not data:
+                raise OSError('Connection closed by server')
+            sink(data)
+            size -= len(data)
+
+    def read_exactly(self, size):
+        """
+        Read an exact number of bytes from the connection
+
+        :param size: The number of bytes to read
+        :type size: int
+        :return: The data read
+        :rtype: bytes
+        """
+        data = self.sock.read(size)
+        if data is None or len(data) == size:
+            return data or b''
+        chunks = [data]
+        size -= len(data)
+        while size > 0:
+            data = self.sock.read(min(size, self.READ_CHUNK_SIZE))
+            if not data:
+                raise OSError('Connection closed by server')
+            chunks.append(data)
+            size -= len(data)
+        return b''.join(chunks)
+
+
+class OTARepo:
+    """
+    This class polls a single GitHub repository for new commits. Only when the repo
+    has changed are the files in it compared against the repo tree, and only the
+    files whose blob sha differs are pulled down. The tree only carries metadata,
+    so no file content is transferred for files that have not changed.
+
+    Attributes:
+        repository - The GitHub repository
+        files - A list of OTAFileMetadata objects for files in the repository
+    """
+
+    def __init__(self, repository, files, session, request_header, sha_header, debug=False):
+        """
+        Initializer
+
+        :param repository: The GitHub repository
+        :type repository: str
+        :param files: OTAFileMetadata objects for files in the repository
+        :type files: list
+        :param session: The HTTP session used to talk to GitHub
+        :type session: OTAHTTPSession
+        :param request_header: The (shared) GitHub API request headers
+        :type request_header: dict
+        :param sha_header: The (shared) request headers for commit sha values
+        :type sha_header: dict
+        :param debug: Enable debug
+        :type debug: bool
+        """
+        self.repo = repository
+        self.files = files
+        self.session = session
+        self.debug = debug
+        self.path = f'/repos/{self.repo}'
+        self.last_commit_sha = None
+        self.etag = None
+        self.request_header = request_header
+        self.sha_header = sha_header
+
+    def get_json(self, path):
+        """
+        Make a GET request to the GitHub API
+
+        :param path: The API path
+        :type path: str
+        :return: The status code and the decoded json
+        :rtype: tuple
+        """
+        try:
+            status, _, body = self.session.get(path, self.request_header)
+            response = json.loads(body)
+            return status, response
+        except MemoryError:
+            raise OTANoMemory()
+
+    def get_file_shas(self, commit_sha):
+        """
+        Get the blob sha values and sizes of all our files with one request. Only the
+        top level tree is needed, since only files in the top level are supported.
+
+        :param commit_sha: The sha value of the commit (GitHub resolves it to its tree)
+        :type commit_sha: str
+        :return: A dictionary of file paths and their sha values and sizes (empty on error)
+        :rtype: dict
+        """
+        shas = {}
+        try:
+            _, response = self.get_json(f'{self.path}/git/trees/{commit_sha}')
+        except ValueError:
+            print("OTAR: Json error in tree response")
+            return shas
+        filenames = [entry.filename for entry in self.files]
+        for item in response.get('tree', []):
+            # Only keep what we need out of the tree, the rest can go straight away
+            if item['type'] == 'blob' and item['path'] in filenames:
+                shas[item['path']] = (item['sha'], item['size'])
+        # Drop the parsed tree before collecting, so its memory is actually freed
+        response = item = None
+        gc.collect()
+        return shas
+
+    def get_head_sha(self):
+        """
+        Make a conditional request for the sha value of the newest commit. Asking for the
+        'sha' media type gets back just the 40 character sha value rather than the whole
+        commit as json, so there is nothing to parse.
+
+        :return: The status code, the response ETag and the commit sha (None if not modified)
+        :rtype: tuple
+        """
+        try:
+            status, headers, body = self.session.get(f'{self.path}/commits/HEAD', self.sha_header, self.etag)
+        except MemoryError:
+            raise OTANoMemory()
+        if status == 304:
+            return status, self.etag, None
+        if status != 200:
+            print("OTAR: URL = ", self.path)
+            print("OTAR: response = ", status, body)
+            return status, None, None
+        return status, headers.get('etag'), body.decode().strip()
+
+    def fetch_updates(self):
+        """
+        Check the repo for new commits. If there are any, update each file that
+        changed to the latest GitHub version
+
+        :return: Nothing
+        """
+        status, etag, commit_sha = self.get_head_sha()
+        if status == 304:
+            if self.debug:
+                print(f"OTAR: {self.repo} not modified")
+            return
+        if not commit_sha:
+            return
+        if commit_sha != self.last_commit_sha:
+            shas = self.get_file_shas(commit_sha)
+            if not shas:
+                # Couldn't get the tree. Try again next time.
+                print(f"OTAR: No tracked files found in {self.repo}")
+                return
+            all_pulled = True
+            for entry in self.files:
+                blob = shas.get(entry.filename)
+                if blob is None:
+                    print(f"OTAR: {entry.filename} not found in {self.repo}")
+                else:
+                    if self.debug:
+                        print(f"OTAR: ... {entry.filename}")
+                    if not entry.update_latest(*blob):
+                        all_pulled = False
+            if not all_pulled:
+                # Don't remember the commit, so the failed files are tried again next time
+                return
+        # Only remember the commit once all the files have been brought up to date
+        self.last_commit_sha = commit_sha
+        self.etag = etag
+
+
 class OTAFileMetadata:
     """
     This class contains the version metadata for individual files on GitHub.
@@ -305,11 +758,11 @@ class OTAFileMetadata:
     """
 
     LATEST_FILE_PREFIX = '__latest__'
+    DOWNLOAD_FILE_PREFIX = '__download__'
     ERROR_FILE_PREFIX = '__error__'
     BACKUP_FILE_PREFIX = '__backup__'
-    OTA_MINIMUM_MEMORY = 32000
 
-    def __init__(self, user, token, repository, filename, debug=False, save_backups=False):
+    def __init__(self, repository, filename, session, raw_header, debug=False, save_backups=False):
         """
         Initializer
 
@@ -317,29 +770,24 @@ class OTAFileMetadata:
         :type repository: str
         :param filename: A file to monitor and update
         :type filename: str
+        :param session: The HTTP session used to talk to GitHub
+        :type session: OTAHTTPSession
+        :param raw_header: The (shared) request headers for raw file downloads
+        :type raw_header: dict
         :param debug: Enable debug
         :type debug: bool
         """
         gc.enable()  # mem leak bugs
+        self.repo = repository
         self.filename = filename
-        self.url = f'https://api.github.com/repos/{repository}/contents/{self.filename}'
+        self.session = session
         self.debug = debug
         self.save_backups = save_backups
         self.latest = None
         self.latest_file = None
+        self._pending_sha = None  # sha of latest_file, worked out as it is downloaded
         self.current = calculate_github_sha(self.filename)
-        self.request_header = {
-            "Authorization": f"token {token}",
-            'User-Agent': user
-        }
-        self.update_latest()
-
-    def debug_print(self, msg):
-        """
-        Print only when debug is enabled
-        """
-        if self.debug:
-            print(msg)
+        self.raw_header = raw_header
 
     def to_json(self):
         """
@@ -355,49 +803,80 @@ class OTAFileMetadata:
             }
         }
 
-    def mem_check(self):
+    def update_latest(self, latest, size):
         """
-        There is a known mem leak in 'urequests'. Below is a workaround attempt
+        Record the latest GitHub sha value of our file and, if it differs from the
+        current one, pull the new version down from GitHub
+
+        :param latest: The latest GitHub sha value (e.g. from the repo tree)
+        :type latest: str
+        :param size: The size of the latest version in bytes
+        :type size: int
+        :return: False if the new version could not be pulled down, True otherwise
+        :rtype: bool
         """
-        gc.collect()
-        free_mem = gc.mem_free()
-        self.debug_print(f"OTAF: Free mem: {free_mem}")
-        if free_mem < self.OTA_MINIMUM_MEMORY:
-            raise OTANoMemory()
-
-    def update_latest(self):
+        if latest == self.current:
+            self.latest = latest
+            return True
+        # Download to a temporary file. Until the download has completed and validated,
+        # latest_file (and any earlier version pulled into it) is left untouched.
+        download_file = self.DOWNLOAD_FILE_PREFIX + self.filename
+        # The file is written and hashed a chunk at a time as it arrives, so it is never
+        # held in memory as a whole or read back to work out its sha value.
+        s = hashlib.sha1()
+        s.update("blob %u\0" % size)
+        try:
+            with open(download_file, 'wb') as f:
+                def sink(chunk):
+                    s.update(chunk)
+                    f.write(chunk)
+
+                # Ask for the raw file so there is no json or base64 to decode
+                status, _, body = self.session.get(self.get_path(), self.raw_header, sink=sink)
+        except Exception as e:
+            # Don't leave a partial download behind
+            if file_exists(download_file):
+                os.remove(download_file)
+            if isinstance(e, MemoryError):
+                raise OTANoMemory()
+            raise
+        if status != 200:
+            os.remove(download_file)
+            print("OTAF: URL = ", self.get_path())
+            print("OTAF: response = ", status, body)
+            time.sleep(1)
+            return False
+        pending_sha = ubinascii.hexlify(s.digest()).decode()
+        if pending_sha != latest:
+            # Cut short or otherwise not what GitHub says it should be
+            os.remove(download_file)
+            print(f"OTAF: {self.filename} download does not match sha {latest}")
+            return False
+        if not valid_code(download_file):
+            error_file = self.ERROR_FILE_PREFIX + self.filename
+            # keep a copy for forensics
+            os.rename(download_file, error_file)
+            raise OTANewFileWillNotValidate(f'New {self.filename} will not validate')
+        # Only now is there a new version on hand to switch to
+        latest_file = self.LATEST_FILE_PREFIX + self.filename
+        if file_exists(latest_file):
+            # Not every filesystem will rename over an existing file
+            os.remove(latest_file)
+        os.rename(download_file, latest_file)
+        self.latest_file = latest_file
+        self._pending_sha = pending_sha
+        self.latest = latest
+        return True
+
+    def get_path(self):
         """
-        Query GitHub for the latest version of our file
+        Get the GitHub API path of the file we are monitoring. It is only needed
+        when the file is pulled, so it is not kept around.
 
-        :return: Nothing
+        :return: The API path
+        :rtype: str
         """
-        self.mem_check()
-        try:
-            response = requests.get(self.url, headers=self.request_header).json()
-        except ValueError:
-            print("OTAF: Json error in response")
-            print("OTAF: URL = ", self.url)
-        except MemoryError:
-            raise OTANoMemory()
-        else:
-            self.mem_check()
-            if 'sha' in response:
-                self.latest = response['sha']
-                if self.new_version_available():
-                    file_content = ubinascii.a2b_base64(response['content'])
-                    self.latest_file = self.LATEST_FILE_PREFIX + self.get_filename()
-                    with open(self.latest_file, 'w') as f:
-                        f.write(str(file_content, 'utf-8'))
-                    if not valid_code(self.latest_file):
-                        error_file = self.ERROR_FILE_PREFIX + self.get_filename()
-                        # keep a copy for forensics
-                        os.rename(self.latest_file, error_file)
-                        self.latest_file = None
-                        raise OTANewFileWillNotValidate(f'New {self.get_filename()} will not validate')
-            else:
-                print("OTAF: URL = ", self.url)
-                print("OTAF: response = ", response)
-                time.sleep(1)
+        return '/repos/' + self.repo + '/contents/' + self.filename
 
     def get_filename(self):
         """
@@ -430,16 +909,22 @@ class OTAFileMetadata:
         """
         Set the current value to the latest value
 
-        :return: Nothing
+        :return: True if the file was replaced with the latest version, False otherwise
+        :rtype: bool
         """
-        if self.save_backups and bool(self.get_filename() in os.listdir()):
-            backup_file = self.BACKUP_FILE_PREFIX + self.get_filename()
-            os.rename(self.get_filename(), backup_file)
-        self.debug_print(f"renaming latest: {self.latest_file} to {self.get_filename()}")
-        if self.latest_file:
-            os.rename(self.latest_file, self.get_filename())
-            self.current = self.latest
-
+        if not self.latest_file:
+            # Nothing was pulled down, so leave the live file alone
+            return False
+        if self.save_backups and file_exists(self.filename):
+            backup_file = self.BACKUP_FILE_PREFIX + self.filename
+            os.rename(self.filename, backup_file)
+        if self.debug:
+            print(f"renaming latest: {self.latest_file} to {self.filename}")
+        os.rename(self.latest_file, self.filename)
+        self.latest_file = None
+        # The sha of what was actually written, already checked against GitHub's
+        self.current = self._pending_sha
+        return True
 
     def new_version_available(self):
         """
@@ -449,7 +934,7 @@ class OTAFileMetadata:
         :return: True or False
         :rtype: bool
         """
-        return bool(self.current != self.latest)
+        return self.latest is not None and self.current != self.latest
 
 
 class OTADatabase:
@@ -460,6 +945,7 @@ class OTADatabase:
         :param: memory_resident_version_list - A list of OTAFileMetadata objects
     """
     DB_FILE = 'versions.json'
+    LAST_UPDATE_KEY = '__last_update_time__'
 
     def __init__(self, memory_resident_version_list, debug=False):
         """
@@ -476,36 +962,22 @@ class OTADatabase:
         self.filename = self.DB_FILE
         self.debug = debug
         self.version_entries = memory_resident_version_list
-        if self.db_file_exists():
-            for version_entry in self.version_entries:
-                filename = version_entry.get_filename()
-                if not self.entry_exists(filename):
-                    self.create(version_entry.to_json())
-        else:
-            for entry in self.version_entries:
-                self.create(entry.to_json())
-
-    def debug_print(self, msg):
+        # The database is read from flash once and then kept in memory. Changes
+        # are only written back by commit().
+        self._data = self.load() or {}
+        self._dirty = False
+        # Usually every file already has an entry, in which case nothing is written
+        missing = [entry for entry in self.version_entries if entry.filename not in self._data]
+        if missing:
+            for entry in missing:
+                self.stage(entry.to_json())
+            self.commit()
+
+    def load(self):
         """
-        Print only when debug enabled
-        """
-        if self.debug:
-            print(msg)
-
-    def db_file_exists(self):
-        """
-        Does our database file exist?
+        Load the entire database from flash
 
-        :return: True or False
-        :rtype: bool
-        """
-        return bool(self.filename in os.listdir())
-
-    def read(self):
-        """
-        Read the entire database
-
-        :return: A json string or None if the db doesn't exist
+        :return: A json string or None if the db doesn't exist or can't be parsed
         :rtype: json or None
         """
         try:
@@ -514,17 +986,81 @@ class OTADatabase:
             return data
         except OSError:
             return None
+        except ValueError:
+            print("OTAD: Database is corrupt. Starting a new one")
+            return None
 
     def write(self, data):
         """
-        Write the whole database
+        Write the whole database. It is written to a temporary file first and then
+        renamed, so a crash part way through can't leave a corrupt database behind.
 
         :param data: A list of json strings
         :type data: list
         :return: Nothing
         """
-        with open(self.filename, 'w') as file:
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as file:
             json.dump(data, file)
+        try:
+            os.rename(tmp_filename, self.filename)
+        except OSError:
+            # Not every filesystem will rename over an existing file
+            os.remove(self.filename)
+            os.rename(tmp_filename, self.filename)
+
+    def read(self):
+        """
+        Read the entire database
+
+        :return: The in-memory copy of the database
+        :rtype: json
+        """
+        return self._data
+
+    def stage(self, item):
+        """
+        Add or replace a db entry in memory only. Nothing is written until commit().
+
+        :param item: json string
+        :type item: json
+        :return: Nothing
+        """
+        for key in item:
+            if self._data.get(key) != item[key]:
+                self._data[key] = item[key]
+                self._dirty = True
+
+    def get_last_update_time(self):
+        """
+        Get the (wall clock) time of the last check for updates
+
+        :return: The time in seconds or None if there has not been one
+        :rtype: int or None
+        """
+        return self._data.get(self.LAST_UPDATE_KEY)
+
+    def set_last_update_time(self, update_time):
+        """
+        Stage the (wall clock) time of the last check for updates
+
+        :param update_time: The time in seconds
+        :type update_time: int
+        :return: Nothing
+        """
+        self.stage({self.LAST_UPDATE_KEY: update_time})
+
+    def commit(self):
+        """
+        Write all staged changes back to flash at once, but only if there are any
+
+        :return: Nothing
+        """
+        if self._dirty:
+            if self.debug:
+                print("OTAD: Writing database")
+            self.write(self._data)
+            self._dirty = False
 
     def create(self, item):
         """
@@ -536,11 +1072,7 @@ class OTADatabase:
         """
         filename = list(item)[0]
         if not self.entry_exists(filename):
-            data = self.read()
-            if not data:
-                data = {}
-            data.update(item)
-            self.write(data)
+            self.stage(item)
         else:
             raise RuntimeError(f'OTAD: Already an entry for {filename} in database')
 
@@ -553,14 +1085,7 @@ class OTADatabase:
         :return: True or False
         :rtype: bool
         """
-        entry_exists = False
-        data = self.read()
-        if data:
-            for key in data.keys():
-                if bool(key == filename):
-                    entry_exists = True
-                    break
-        return entry_exists
+        return filename in self.read()
 
     def get_entry(self, filename):
         """
@@ -571,13 +1096,7 @@ class OTADatabase:
         :return: json string or None if not found
         :rtype: json or None
         """
-        retval = None
-        data = self.read()
-        if data:
-            for key in data.keys():
-                if bool(key == filename):
-                    retval = data[key]
-        return retval
+        return self.read().get(filename)
 
     def update(self, new_item):
         """
@@ -587,11 +1106,7 @@ class OTADatabase:
         :type new_item: json
         :return: Nothing
         """
-        filename = list(new_item)[0]
-        data = self.read()
-        self.delete(filename)
-        data.update(new_item)
-        self.write(data)
+        self.stage(new_item)
 
     def delete(self, filename):
         """
@@ -601,7 +1116,6 @@ class OTADatabase:
         :type filename: str
         :return: Nothing
         """
-        data = self.read()
         if self.entry_exists(filename):
-            del data[filename]
-            self.write(data)
+            del self._data[filename]
+            self._dirty = True